@@ -13,7 +13,7 @@ import mimetypes
 from requests.exceptions import RequestException, ConnectionError, Timeout
 from .common import DownloaderBase
 from .. import text, util, output
-from .segmented import DownloadManager
+from .segmented import DownloadManager, setup_signal_handler
 from ssl import SSLError
 
 
@@ -44,6 +44,9 @@ class HttpDownloader(DownloaderBase):
         self.segmented = self.config("downloader-segmented", False)
         interval_429 = self.config("sleep-429")
 
+        if self.segmented:
+            setup_signal_handler()
+
         if not self.config("consume-content", False):
             # this resets the underlying TCP connection, and therefore
             # if the program makes another request to the same domain,
@@ -108,7 +111,11 @@ class HttpDownloader(DownloaderBase):
     def _download_impl(self, url, pathfmt):
         if self.segmented:
             manager = DownloadManager(self, url, pathfmt)
-            return manager.download()
+            result = manager.download()
+            if result is not None:
+                return result
+            # server does not support range requests;
+            # fall back to a regular, single connection download
         response = None
         tries = code = 0
         msg = ""
@@ -9,25 +9,45 @@
 """Downloader module for segmented downloading"""
 
 import threading
+import functools
+import queue
+import time
 import os
 import signal
 from enum import Enum
-from .. import util
+from .. import text, util
 
 # Global shutdown event for all segmented downloads
 _global_shutdown_event = threading.Event()
-_global_signal_handler_setup = False
-
-def _setup_global_signal_handler():
-    """Set up global signal handler for graceful shutdown"""
-    global _global_signal_handler_setup
-    if _global_signal_handler_setup:
-        return
-        
+
+# Number of bytes to read from a response at once
+CHUNK_SIZE = 1 << 18
+
+# Smallest segment worth its own worker and HTTP request
+MIN_SEGMENT_SIZE = 1 << 20
+
+if hasattr(os, "pwrite"):
+    _pwrite = os.pwrite
+else:
+    _pwrite_lock = threading.Lock()
+
+    def _pwrite(fd, data, offset):
+        """Emulate 'os.pwrite()' on platforms without it"""
+        with _pwrite_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.write(fd, data)
+
+
+@functools.lru_cache(maxsize=None)
+def setup_signal_handler():
+    """Set up global signal handler for graceful shutdown
+
+    Only the first call has any effect.
+    """
     def signal_handler(signum, frame):
         print("\nReceived interrupt signal, shutting down gracefully...")
         _global_shutdown_event.set()
-    
+
     # Set up signal handlers
     for sig in (signal.SIGINT, signal.SIGTERM):
         try:
@@ -35,8 +55,7 @@ def _setup_global_signal_handler():
         except (OSError, ValueError):
             # Signal not available on this platform
             pass
-    
-    _global_signal_handler_setup = True
+
 
 class SegmentStatus(Enum):
     PENDING = 1
@@ -44,17 +63,22 @@ class SegmentStatus(Enum):
     COMPLETED = 3
     FAILED = 4
 
+
 class Segment:
     """Represents a segment of a file to be downloaded."""
     def __init__(self, start, end, status=SegmentStatus.PENDING):
         self.start = start
         self.end = end
         self.size = end - start + 1
+        # position up to which data has been claimed for writing
+        self.offset = start
         self.status = status
         self.lock = threading.Lock()
 
     def __repr__(self):
-        return f"<Segment start={self.start} end={self.end} size={self.size} status={self.status.name}>"
+        return (f"<Segment start={self.start} end={self.end} "
+                f"size={self.size} status={self.status.name}>")
+
 
 class DownloadManager:
     """Manages the segmented download of a file."""
@@ -66,166 +90,302 @@ class DownloadManager:
         self.log = self.job.get_logger("downloader.segmented")
         self.threads = []
         self.segments = []
+        self._pending = queue.SimpleQueue()
         self.file_size = 0
         self.lock = threading.Lock()
         self.num_threads = self.job.extractor.config("downloader-threads", 4)
         self.out = self.job.out
-        self.downloaded_bytes = 0
-        
-        _setup_global_signal_handler()
+        self._fd = None
+        self._counters = []
+        self._local = threading.local()
+        self._unsupported = threading.Event()
+        self._stop = threading.Event()
 
     def download(self):
+        """Download 'self.url' using multiple connections
+
+        Returns None when the server does not support range requests
+        and the file needs to be downloaded with a single connection.
+        """
         try:
             if _global_shutdown_event.is_set():
                 return False
-                
+
             # Ensure pathfmt is properly set up
             if not self.pathfmt.temppath:
                 if self.http_downloader.part:
                     self.pathfmt.part_enable(self.http_downloader.partdir)
                 if not self.pathfmt.temppath:
                     self.pathfmt.build_path()
-            
+
             # Ensure realpath points to the final filename (without .part)
-            if self.pathfmt.temppath.endswith('.part') and self.pathfmt.realpath.endswith('.part'):
+            if self.pathfmt.temppath.endswith(".part") and \
+                    self.pathfmt.realpath.endswith(".part"):
                 self.pathfmt.realpath = self.pathfmt.temppath[:-5]
                 self.pathfmt.path = self.pathfmt.realpath
-            
-            self._get_file_size()
-            self._create_initial_segments()
 
-            for _ in range(self.num_threads):
-                thread = threading.Thread(target=self._worker)
-                self.threads.append(thread)
-                thread.start()
+            # request the entire file and use this response
+            # to learn its size and to download the first segment
+            response = self._request_range(0)
+            if response.status_code != 206:
+                self.log.debug("Range requests not supported (%s %s)",
+                               response.status_code, response.reason)
+                response.close()
+                return None
+            self.file_size = self._get_file_size(response)
+            if not self.file_size:
+                self.log.debug("Unknown file size (%s)",
+                               response.headers.get('Content-Range'))
+                response.close()
+                return None
+            first_segment = self._create_initial_segments()
+            self._open_file()
+
+            finished = threading.Event()
+            reporter = threading.Thread(
+                target=self._reporter, args=(finished,), daemon=True)
+            try:
+                reporter.start()
+
+                # the current thread acts as worker 0
+                for wid in range(1, self.num_threads):
+                    thread = threading.Thread(
+                        target=self._worker, args=(wid,))
+                    thread.start()
+                    self.threads.append(thread)
+                self._worker(0, first_segment, response)
+            except BaseException:
+                self._stop.set()
+                response.close()
+                raise
+            finally:
+                # wait for all threads before closing 'self._fd'
+                for thread in self.threads:
+                    thread.join()
+                finished.set()
+                if reporter.is_alive():
+                    reporter.join()
 
-            for thread in self.threads:
-                thread.join()
+            self._close_file()
 
             if _global_shutdown_event.is_set():
                 self.log.warning("Download was interrupted")
                 self._cleanup_partial_files()
                 return False
 
-            self._assemble_file()
+            if self._unsupported.is_set():
+                self.log.debug("Server stopped honoring range requests")
+                self._cleanup_partial_files()
+                return None
+
+            for segment in self.segments:
+                if segment.status != SegmentStatus.COMPLETED:
+                    self.log.error("Incomplete download (%s)", segment)
+                    self._cleanup_partial_files()
+                    return False
+
             result = self.pathfmt.finalize()
-            
+
             return True
         except Exception as e:
             self.log.error(f"Error during segmented download: {e}")
             return False
+        finally:
+            self._close_file()
+
+    def _open_file(self):
+        """Create and preallocate the output file"""
+        os.makedirs(self.pathfmt.realdirectory, exist_ok=True)
+
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        self._fd = fd = os.open(
+            self.pathfmt.temppath, flags | getattr(os, "O_BINARY", 0))
+        try:
+            os.posix_fallocate(fd, 0, self.file_size)
+        except (AttributeError, OSError):
+            # not supported by this platform or filesystem
+            os.ftruncate(fd, self.file_size)
+
+    def _close_file(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
 
     def _cleanup_partial_files(self):
-        """Clean up partial segment files when interrupted"""
+        """Remove the incomplete output file"""
         try:
-            for segment in self.segments:
-                if segment.status == SegmentStatus.COMPLETED:
-                    part_path = f"{self.pathfmt.temppath}.part{segment.start}"
-                    util.remove_file(part_path)
+            util.remove_file(self.pathfmt.temppath)
         except Exception as e:
             self.log.debug(f"Error during cleanup: {e}")
 
-    def _get_file_size(self):
-        response = self.http_downloader.session.head(self.url, timeout=self.http_downloader.timeout)
+    def _request_range(self, start, end=""):
+        headers = {
+            'Range': f'bytes={start}-{end}',
+            # byte ranges refer to the encoded data,
+            # which gets written as is
+            'Accept-Encoding': 'identity',
+        }
+        response = self.http_downloader.session.get(
+            self.url, headers=headers, stream=True,
+            timeout=self.http_downloader.timeout)
         response.raise_for_status()
-        self.file_size = int(response.headers['Content-Length'])
+        return response
+
+    def _get_file_size(self, response):
+        """Return the total file size or 0 if it is unknown"""
+        # 'Content-Range: bytes <start>-<end>/<size>' or '.../*'
+        content_range = response.headers.get('Content-Range') or ''
+        return text.parse_int(content_range.rpartition('/')[2])
 
     def _create_initial_segments(self):
+        # do not start more workers than there are segments to download
+        self.num_threads = max(1, min(
+            self.num_threads, self.file_size // MIN_SEGMENT_SIZE))
+        self._counters = [0] * self.num_threads
+
         segment_size = self.file_size // self.num_threads
         for i in range(self.num_threads):
             start = i * segment_size
             end = start + segment_size - 1
             if i == self.num_threads - 1:
                 end = self.file_size - 1
-            self.segments.append(Segment(start, end))
-
-    def _worker(self):
-        while not _global_shutdown_event.is_set():
-            segment = self._get_next_segment()
-            if not segment:
-                segment = self._split_largest_segment()
-                if not segment:
-                    break
+            segment = Segment(start, end)
+            self.segments.append(segment)
+            if i:
+                self._pending.put(segment)
+
+        # the first segment is downloaded by the current thread
+        return self.segments[0]
+
+    def _reporter(self, finished, interval=0.2):
+        """Periodically report the combined progress of all workers"""
+        counters = self._counters
+        progress = self.out.progress
+        time_start = time.monotonic()
+
+        while True:
+            # report once more after all workers are done
+            done = finished.wait(interval)
+            bytes_downloaded = sum(counters)
+            time_elapsed = time.monotonic() - time_start
+            progress(self.file_size, bytes_downloaded,
+                     int(bytes_downloaded / time_elapsed)
+                     if time_elapsed else 0)
+            if done:
+                break
+
+    def _worker(self, wid, segment=None, response=None):
+        self._local.wid = wid
+        get_segment = self._pending.get_nowait
+        while not _global_shutdown_event.is_set() and \
+                not self._unsupported.is_set() and \
+                not self._stop.is_set():
+            if segment is None:
+                try:
+                    segment = get_segment()
+                except queue.Empty:
+                    segment = self._split_largest_segment()
+                    if not segment:
+                        break
 
             try:
-                self._download_segment(segment)
+                self._download_segment(segment, response)
             except Exception as e:
                 if _global_shutdown_event.is_set():
                     break
                 self.log.error(f"Failed to download segment {segment}: {e}")
                 with segment.lock:
                     segment.status = SegmentStatus.FAILED
+            segment = response = None
 
-    def _download_segment(self, segment):
+        if response is not None:
+            # stopped before using the response passed by the caller
+            response.close()
+
+    def _download_segment(self, segment, response=None):
         with segment.lock:
             segment.status = SegmentStatus.DOWNLOADING
 
-        headers = {'Range': f'bytes={segment.start}-{segment.end}'}
-        response = self.http_downloader.session.get(self.url, headers=headers, stream=True, timeout=self.http_downloader.timeout)
-        response.raise_for_status()
+        if response is None:
+            response = self._request_range(segment.start, segment.end)
+            if response.status_code != 206:
+                # server sent the whole file instead of the requested range
+                response.close()
+                with segment.lock:
+                    segment.status = SegmentStatus.FAILED
+                self._unsupported.set()
+                return
 
-        os.makedirs(self.pathfmt.realdirectory, exist_ok=True)
+        fd = self._fd
+        lock = segment.lock
+        offset = segment.start
+        counters = self._counters
+        wid = self._local.wid
+        # read raw, undecoded data
+        # to avoid the per-chunk overhead of 'iter_content()'
+        raw = response.raw
+        raw.decode_content = False
+        read = raw.read
+        while chunk := read(CHUNK_SIZE):
+            with lock:
+                # 'segment.end' shrinks when this segment gets split
+                size = min(len(chunk), segment.end + 1 - offset)
+                if size > 0:
+                    segment.offset = offset + size
 
-        temp_part_path = os.path.join(self.pathfmt.realdirectory, f"{os.path.basename(self.pathfmt.temppath)}.part{segment.start}")
-        with open(temp_part_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
-                    with self.lock:
-                        self.downloaded_bytes += len(chunk)
-                        self.out.progress(self.file_size, self.downloaded_bytes, 0)
-                
-                if _global_shutdown_event.is_set():
-                    response.close()
-                    return
+            if size > 0:
+                if size < len(chunk):
+                    chunk = chunk[:size]
+                _pwrite(fd, chunk, offset)
+                offset += size
+                # only this worker writes to its own counter slot
+                counters[wid] += size
+
+            if offset > segment.end:
+                response.close()
+                break
+            if _global_shutdown_event.is_set() or \
+                    self._unsupported.is_set() or self._stop.is_set():
+                response.close()
+                return
+
+        if offset <= segment.end:
+            raise OSError(f"Incomplete response ({offset} <= {segment.end})")
 
         with segment.lock:
             segment.status = SegmentStatus.COMPLETED
 
-    def _get_next_segment(self):
-        with self.lock:
-            for segment in self.segments:
-                with segment.lock:
-                    if segment.status == SegmentStatus.PENDING:
-                        return segment
-            return None
-
     def _split_largest_segment(self):
         largest_segment = None
+        largest_remaining = MIN_SEGMENT_SIZE
+        for segment in tuple(self.segments):
+            with segment.lock:
+                remaining = segment.end - segment.offset + 1
+                if segment.status == SegmentStatus.DOWNLOADING and \
+                        remaining > largest_remaining:
+                    largest_segment = segment
+                    largest_remaining = remaining
+
+        if not largest_segment:
+            return None
+
+        with largest_segment.lock:
+            # re-check, the segment might have progressed or
+            # another worker might have split it in the meantime
+            remaining = largest_segment.end - largest_segment.offset + 1
+            if largest_segment.status != SegmentStatus.DOWNLOADING or \
+                    remaining <= MIN_SEGMENT_SIZE:
+                return None
+
+            # split the part that has not been downloaded yet
+            old_end = largest_segment.end
+            split_point = largest_segment.offset + remaining // 2 - 1
+            largest_segment.end = split_point
+            largest_segment.size = split_point - largest_segment.start + 1
+
+            new_segment = Segment(
+                split_point + 1, old_end, SegmentStatus.DOWNLOADING)
+
         with self.lock:
-            for segment in self.segments:
-                with segment.lock:
-                    if segment.status == SegmentStatus.DOWNLOADING and (not largest_segment or segment.size > largest_segment.size):
-                        largest_segment = segment
-
-            if largest_segment and largest_segment.size > 1024 * 1024:
-                with largest_segment.lock:
-                    old_end = largest_segment.end
-                    split_point = largest_segment.start + largest_segment.size // 2
-                    largest_segment.end = split_point
-                    largest_segment.size = largest_segment.end - largest_segment.start + 1
-
-                    new_segment = Segment(split_point + 1, old_end)
-                    self.segments.append(new_segment)
-                    return new_segment
-        return None
-
-    def _assemble_file(self):
-        os.makedirs(self.pathfmt.realdirectory, exist_ok=True)
-        
-        if not self.pathfmt.temppath:
-            self.log.error("No temppath available for assembly")
-            return
-            
-        with open(self.pathfmt.temppath, 'wb') as f:
-            for segment in sorted(self.segments, key=lambda s: s.start):
-                part_path = f"{self.pathfmt.temppath}.part{segment.start}"
-                try:
-                    with open(part_path, 'rb') as part_file:
-                        data = part_file.read()
-                        f.write(data)
-                    util.remove_file(part_path)
-                except FileNotFoundError:
-                    self.log.warning(f"Segment file {part_path} not found during assembly")
-                except Exception as e:
-                    self.log.error(f"Error reading segment {part_path}: {e}")
\ No newline at end of file
+            self.segments.append(new_segment)
+        return new_segment
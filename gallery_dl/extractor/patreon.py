@@ -11,8 +11,72 @@
 from .common import Extractor, Message
 from .. import text, util, exception
 from ..cache import memcache
-import collections
-import itertools
+
+# last path segment with exactly 32 characters
+HASH_PATTERN = r"(?:.*/)?([^/]{32})(?:/|$)"
+
+# '%s' placeholders for an API endpoint and extra query parameters
+API_URL_FMT = (
+    "https://www.patreon.com/api/%s"
+
+    "?include=campaign,access_rules,attachments,attachments_media,"
+    "audio,images,media,native_video_insights,poll.choices,"
+    "poll.current_user_responses.user,"
+    "poll.current_user_responses.choice,"
+    "poll.current_user_responses.poll,"
+    "user,user_defined_tags,ti_checks"
+
+    "&fields[campaign]=currency,show_audio_post_download_links,"
+    "avatar_photo_url,avatar_photo_image_urls,earnings_visibility,"
+    "is_nsfw,is_monthly,name,url"
+
+    "&fields[post]=change_visibility_at,comment_count,commenter_count,"
+    "content,current_user_can_comment,current_user_can_delete,"
+    "current_user_can_view,current_user_has_liked,embed,image,"
+    "insights_last_updated_at,is_paid,like_count,meta_image_url,"
+    "min_cents_pledged_to_view,post_file,post_metadata,published_at,"
+    "patreon_url,post_type,pledge_url,preview_asset_type,thumbnail,"
+    "thumbnail_url,teaser_text,title,upgrade_url,url,"
+    "was_posted_by_campaign_owner,has_ti_violation,moderation_status,"
+    "post_level_suspension_removal_date,pls_one_liners_by_category,"
+    "video_preview,view_count"
+
+    "&fields[post_tag]=tag_type,value"
+    "&fields[user]=image_url,full_name,url"
+    "&fields[access_rule]=access_rule_type,amount_cents"
+    "&fields[media]=id,image_urls,download_url,metadata,file_name"
+    "&fields[native_video_insights]=average_view_duration,"
+    "average_view_pct,has_preview,id,last_updated_at,num_views,"
+    "preview_views,video_duration%s"
+
+    "&json-api-version=1.0"
+)
+
+
+@memcache(keyarg=1)
+def _filename_path(extr, path, url):
+    """Return the Content-Disposition filename of 'url', cached by 'path'"""
+    response = extr.request(url, method="HEAD", fatal=False)
+    cd = response.headers.get("Content-Disposition")
+    return text.extr(cd, 'filename="', '"')
+
+
+@memcache(keyarg=0)
+def _file_generator_names(filetypes):
+    """Return the method names of all file generators for 'filetypes'"""
+    if filetypes is None:
+        return ("_images", "_image_large",
+                "_attachments", "_postfile", "_content")
+    genmap = {
+        "images"     : "_images",
+        "image_large": "_image_large",
+        "attachments": "_attachments",
+        "postfile"   : "_postfile",
+        "content"    : "_content",
+    }
+    if isinstance(filetypes, str):
+        filetypes = filetypes.split(",")
+    return tuple(genmap[ft] for ft in filetypes)
 
 
 class PatreonExtractor(Extractor):
@@ -27,6 +91,8 @@ class PatreonExtractor(Extractor):
     _warning = True
 
     def _init(self):
+        self._find_hash = util.re(HASH_PATTERN).match
+
         if not self.cookies_check(("session_id",), subdomains=True):
             if self._warning:
                 PatreonExtractor._warning = False
@@ -49,13 +115,21 @@ class PatreonExtractor(Extractor):
                 self.log.warning("Not allowed to view post %s", post["id"])
                 continue
 
+            # collect unique URLs first,
+            # keeping the first 'kind' and 'name' for each
+            files = {}
+            for generator in generators:
+                for kind, url, name in generator(post):
+                    files.setdefault(url, (kind, name))
+
             post["num"] = 0
             hashes = set()
-            for kind, url, name in itertools.chain.from_iterable(
-                    g(post) for g in generators):
+            for url, (kind, name) in files.items():
                 fhash = self._filehash(url)
                 if fhash not in hashes or not fhash:
                     hashes.add(fhash)
+                    if name is None:
+                        name = self._filename(url) or url
                     post["hash"] = fhash
                     post["type"] = kind
                     post["num"] += 1
@@ -75,10 +149,8 @@ class PatreonExtractor(Extractor):
         if postfile := post.get("post_file"):
             url = postfile["url"]
             if not (name := postfile.get("name")):
-                if url.startswith("https://stream.mux.com/"):
-                    name = url
-                else:
-                    name = self._filename(url) or url
+                name = url if url.startswith("https://stream.mux.com/") \
+                    else None
             return (("postfile", url, name),)
         return ()
 
@@ -86,8 +158,7 @@ class PatreonExtractor(Extractor):
         if images := post.get("images"):
             for image in images:
                 if url := self._images_url(image):
-                    name = image.get("file_name") or self._filename(url) or url
-                    yield "image", url, name
+                    yield "image", url, image.get("file_name") or None
 
     def _images_url(self, image):
         return image.get("download_url")
@@ -101,8 +172,7 @@ class PatreonExtractor(Extractor):
     def _image_large(self, post):
         if image := post.get("image"):
             if url := image.get("large_url"):
-                name = image.get("file_name") or self._filename(url) or url
-                return (("image_large", url, name),)
+                return (("image_large", url, image.get("file_name") or None),)
         return ()
 
     def _attachments(self, post):
@@ -116,10 +186,11 @@ class PatreonExtractor(Extractor):
 
     def _content(self, post):
         if content := post.get("content"):
-            for img in text.extract_iter(
-                    content, '<img data-media-id="', '>'):
-                if url := text.extr(img, 'src="', '"'):
-                    yield "content", url, self._filename(url) or url
+            find_urls = util.re(
+                r'<img data-media-id="[^>]*?src="([^">]*)"[^>]*>').findall
+            for url in find_urls(content):
+                if url:
+                    yield "content", url, None
 
     def posts(self):
         """Return all relevant post objects"""
@@ -131,7 +202,10 @@ class PatreonExtractor(Extractor):
 
         while url:
             url = text.ensure_http_scheme(url)
-            posts = self.request_json(url, headers=headers)
+            response = self.request(url, headers=headers)
+            # decode as UTF-8 directly instead of letting 'requests'
+            # guess the encoding of 'application/vnd.api+json' responses
+            posts = util.json_loads(response.content.decode())
 
             if "included" in posts:
                 included = self._transform(posts["included"])
@@ -154,8 +228,7 @@ class PatreonExtractor(Extractor):
             post, included, "attachments")
         attr["attachments_media"] = self._files(
             post, included, "attachments_media")
-        attr["date"] = text.parse_datetime(
-            attr["published_at"], "%Y-%m-%dT%H:%M:%S.%f%z")
+        attr["date"] = text.parse_datetime_iso(attr["published_at"])
 
         try:
             attr["campaign"] = (included["campaign"][
@@ -165,10 +238,10 @@ class PatreonExtractor(Extractor):
 
         tags = relationships.get("user_defined_tags")
         attr["tags"] = [
-            tag["id"].replace("user_defined;", "")
+            tag["id"][13:]  # remove 'user_defined;' prefix
             for tag in tags["data"]
             if tag["type"] == "post_tag"
-        ] if tags else []
+        ] if tags and tags.get("data") else []
 
         user = relationships["user"]
         attr["creator"] = (
@@ -179,9 +252,9 @@ class PatreonExtractor(Extractor):
 
     def _transform(self, included):
         """Transform 'included' into an easier to handle format"""
-        result = collections.defaultdict(dict)
+        result = {}
         for inc in included:
-            result[inc["type"]][inc["id"]] = inc["attributes"]
+            result.setdefault(inc["type"], {})[inc["id"]] = inc["attributes"]
         return result
 
     def _files(self, post, included, key):
@@ -203,77 +276,40 @@ class PatreonExtractor(Extractor):
         user = response.json()["data"]
         attr = user["attributes"]
         attr["id"] = user["id"]
-        attr["date"] = text.parse_datetime(
-            attr["created"], "%Y-%m-%dT%H:%M:%S.%f%z")
+        attr["date"] = text.parse_datetime_iso(attr["created"])
         return attr
 
     def _filename(self, url):
         """Fetch filename from an URL's Content-Disposition header"""
-        response = self.request(url, method="HEAD", fatal=False)
-        cd = response.headers.get("Content-Disposition")
-        return text.extr(cd, 'filename="', '"')
+        # ignore query parameters like 'token-hash' and 'token-time',
+        # which differ for the same file
+        path = url.partition("?")[0]
+        name = _filename_path(self, path, url)
+        if not name:
+            # do not remember failed or header-less HEAD requests
+            _filename_path.invalidate(path)
+        return name
 
     def _filehash(self, url):
         """Extract MD5 hash from a download URL"""
-        parts = url.partition("?")[0].split("/")
-        parts.reverse()
-
-        for part in parts:
+        # check the last three path segments first,
+        # which contain the hash for most URLs
+        parts = url.partition("?")[0].rsplit("/", 3)
+        for part in parts[:0:-1]:
             if len(part) == 32:
                 return part
+        if match := self._find_hash(parts[0]):
+            return match[1]
         return ""
 
     def _build_url(self, endpoint, query):
-        return (
-            f"https://www.patreon.com/api/{endpoint}"
-
-            "?include=campaign,access_rules,attachments,attachments_media,"
-            "audio,images,media,native_video_insights,poll.choices,"
-            "poll.current_user_responses.user,"
-            "poll.current_user_responses.choice,"
-            "poll.current_user_responses.poll,"
-            "user,user_defined_tags,ti_checks"
-
-            "&fields[campaign]=currency,show_audio_post_download_links,"
-            "avatar_photo_url,avatar_photo_image_urls,earnings_visibility,"
-            "is_nsfw,is_monthly,name,url"
-
-            "&fields[post]=change_visibility_at,comment_count,commenter_count,"
-            "content,current_user_can_comment,current_user_can_delete,"
-            "current_user_can_view,current_user_has_liked,embed,image,"
-            "insights_last_updated_at,is_paid,like_count,meta_image_url,"
-            "min_cents_pledged_to_view,post_file,post_metadata,published_at,"
-            "patreon_url,post_type,pledge_url,preview_asset_type,thumbnail,"
-            "thumbnail_url,teaser_text,title,upgrade_url,url,"
-            "was_posted_by_campaign_owner,has_ti_violation,moderation_status,"
-            "post_level_suspension_removal_date,pls_one_liners_by_category,"
-            "video_preview,view_count"
-
-            "&fields[post_tag]=tag_type,value"
-            "&fields[user]=image_url,full_name,url"
-            "&fields[access_rule]=access_rule_type,amount_cents"
-            "&fields[media]=id,image_urls,download_url,metadata,file_name"
-            "&fields[native_video_insights]=average_view_duration,"
-            "average_view_pct,has_preview,id,last_updated_at,num_views,"
-            f"preview_views,video_duration{query}"
-
-            "&json-api-version=1.0"
-        )
+        return API_URL_FMT % (endpoint, query)
 
     def _build_file_generators(self, filetypes):
-        if filetypes is None:
-            return (self._images, self._image_large,
-                    self._attachments, self._postfile, self._content)
-        genmap = {
-            "images"     : self._images,
-            "image_large": self._image_large,
-            "attachments": self._attachments,
-            "postfile"   : self._postfile,
-            "content"    : self._content,
-        }
-        if isinstance(filetypes, str):
-            filetypes = filetypes.split(",")
-        return [genmap[ft] for ft in filetypes]
+        if filetypes is not None and not isinstance(filetypes, str):
+            filetypes = tuple(filetypes)
+        return [getattr(self, name)
+                for name in _file_generator_names(filetypes)]
 
     def _extract_bootstrap(self, page):
         try:
@@ -371,10 +407,11 @@ class PatreonCreatorExtractor(PatreonExtractor):
         raise exception.StopExtraction("Failed to extract campaign ID")
 
     def _get_filters(self, query):
+        escape = text.escape
         return "".join(
-            f"&filter[{key[8:]}={text.escape(value)}"
+            f"&filter[{key[8:]}={escape(value)}"
             for key, value in query.items()
-            if key.startswith("filters[")
+            if key[:8] == "filters["
         )
 
 
@@ -357,6 +357,26 @@ def parse_datetime(date_string, format="%Y-%m-%dT%H:%M:%S%z", utcoffset=0):
         return date_string
 
 
+def parse_datetime_iso(date_string):
+    """Create a datetime object by parsing an ISO 8601 'date_string'"""
+    try:
+        if date_string[-1:] == "Z":
+            # compat for Python < 3.11
+            date_string = date_string[:-1] + "+00:00"
+        d = datetime.datetime.fromisoformat(date_string)
+        o = d.utcoffset()
+        if o is not None:
+            # convert to naive UTC
+            d = d.replace(tzinfo=None, microsecond=0) - o
+        elif d.microsecond:
+            d = d.replace(microsecond=0)
+        return d
+    except (TypeError, IndexError, KeyError):
+        return None
+    except (ValueError, OverflowError):
+        return date_string
+
+
 urljoin = urllib.parse.urljoin
 
 quote = urllib.parse.quote
@@ -23,6 +23,7 @@ import http.server
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from gallery_dl import downloader, extractor, output, config, path  # noqa E402
 from gallery_dl.downloader.http import MIME_TYPES, SIGNATURE_CHECKS # noqa E402
+from gallery_dl.downloader.segmented import DownloadManager  # noqa E402
 
 
 class MockDownloaderModule(Mock):
@@ -237,19 +238,7 @@ class TestHTTPDownloader(TestDownloaderBase):
     def setUpClass(cls):
         TestDownloaderBase.setUpClass()
         cls.downloader = downloader.find("http")(cls.job)
-
-        host = "127.0.0.1"
-        port = 0  # select random not-in-use port
-
-        try:
-            server = http.server.HTTPServer((host, port), HttpRequestHandler)
-        except OSError as exc:
-            raise unittest.SkipTest(
-                "cannot spawn local HTTP server ({})".format(exc))
-
-        host, port = server.server_address
-        cls.address = "http://{}:{}".format(host, port)
-        threading.Thread(target=server.serve_forever, daemon=True).start()
+        cls.address = start_http_server()
 
     def _run_test(self, ext, input, output,
                   extension, expected_extension=None):
@@ -299,6 +288,63 @@ class TestHTTPDownloader(TestDownloaderBase):
         self.assertEqual(pathfmt.temppath, "")
 
 
+class TestHTTPSegmentedDownloader(TestDownloaderBase):
+
+    @classmethod
+    def setUpClass(cls):
+        TestDownloaderBase.setUpClass()
+        config.set(("downloader",), "downloader-segmented", True)
+        # do not replace the test process' SIGINT/SIGTERM handlers
+        with patch("gallery_dl.downloader.http.setup_signal_handler"):
+            cls.downloader = downloader.find("http")(cls.job)
+        # segments are downloaded over concurrent connections
+        cls.address = start_http_server(http.server.ThreadingHTTPServer)
+
+    def _manager(self, path):
+        pathfmt = self._prepare_destination(None, extension="bin")
+        return DownloadManager(self.downloader, self.address + path, pathfmt)
+
+    def _run_test(self, path, output):
+        TestDownloaderBase._run_test(
+            self, self.address + path, None, output, "bin", "bin")
+
+    def test_segmented_download(self):
+        self._run_test("/large", DATA["large"])
+        self._run_test("/jpg", DATA["jpg"])
+
+    def test_segmented_file_size(self):
+        manager = self._manager("/large")
+        self.assertTrue(manager.download())
+
+        # 'large' is 3 MiB and gets split into 3 initial segments
+        self.assertEqual(manager.file_size, len(DATA["large"]))
+        self.assertEqual(manager.num_threads, 3)
+        self.assertEqual(sum(manager._counters), len(DATA["large"]))
+
+    def test_segmented_file_size_unknown(self):
+        manager = self._manager("/unknown/large")
+        self.assertIsNone(manager.download())
+
+        self._run_test("/unknown/large", DATA["large"])
+
+    def test_segmented_fallback(self):
+        manager = self._manager("/norange/large")
+        self.assertIsNone(manager.download())
+
+        self._run_test("/norange/large", DATA["large"])
+
+    def test_segmented_truncated(self):
+        pathfmt = self._prepare_destination(None, extension="bin")
+        url = self.address + "/truncated/large"
+
+        with self.assertLogs("downloader.segmented", "ERROR"):
+            success = self.downloader.download(url, pathfmt)
+
+        self.assertFalse(success)
+        self.assertFalse(os.path.exists(pathfmt.temppath))
+        self.assertFalse(os.path.exists(pathfmt.realpath))
+
+
 class TestTextDownloader(TestDownloaderBase):
 
     @classmethod
@@ -316,35 +362,66 @@ class TestTextDownloader(TestDownloaderBase):
         self._run_test("text:", None, "", "txt", "txt")
 
 
+def start_http_server(server_class=http.server.HTTPServer):
+    """Start a local HTTP server and return its address"""
+    host = "127.0.0.1"
+    port = 0  # select random not-in-use port
+
+    try:
+        server = server_class((host, port), HttpRequestHandler)
+    except OSError as exc:
+        raise unittest.SkipTest(
+            "cannot spawn local HTTP server ({})".format(exc))
+
+    host, port = server.server_address
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return "http://{}:{}".format(host, port)
+
+
 class HttpRequestHandler(http.server.BaseHTTPRequestHandler):
 
     def do_GET(self):
+        # optional '/<mode>/' prefix:
+        #   norange   - ignore 'Range' headers
+        #   unknown   - do not send the total size in 'Content-Range'
+        #   truncated - send only half of each range not starting at 0
+        mode, _, name = self.path[1:].rpartition("/")
         try:
-            output = DATA[self.path[1:]]
+            output = DATA[name]
         except KeyError:
             self.send_response(404)
             self.wfile.write(self.path.encode())
             return
 
-        headers = {"Content-Length": len(output)}
+        headers = {}
 
-        if "Range" in self.headers:
+        if "Range" in self.headers and mode != "norange":
             status = 206
 
-            match = re.match(r"bytes=(\d+)-", self.headers["Range"])
+            match = re.match(r"bytes=(\d+)-(\d*)", self.headers["Range"])
             start = int(match[1])
+            end = int(match[2]) if match[2] else len(output)-1
 
             headers["Content-Range"] = "bytes {}-{}/{}".format(
-                start, len(output)-1, len(output))
-            output = output[start:]
+                start, end, "*" if mode == "unknown" else len(output))
+            output = output[start:end+1]
+            headers["Content-Length"] = len(output)
+
+            if mode == "truncated" and start:
+                output = output[:len(output) // 2]
         else:
             status = 200
+            headers["Content-Length"] = len(output)
 
         self.send_response(status)
         for key, value in headers.items():
             self.send_header(key, value)
         self.end_headers()
-        self.wfile.write(output)
+        try:
+            self.wfile.write(output)
+        except (BrokenPipeError, ConnectionResetError):
+            # client stopped reading, e.g. at the end of a segment
+            pass
 
 
 SAMPLES = {
@@ -410,6 +487,8 @@ for ext, content in SAMPLES:
 for idx, (_, content) in enumerate(SAMPLES):
     DATA["S{:>02}".format(idx)] = content
 
+DATA["large"] = os.urandom(3 * 1024 * 1024)
+
 
 # reverse mime types mapping
 MIME_TYPES = {
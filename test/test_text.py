@@ -549,6 +549,31 @@ class TestText(unittest.TestCase):
             self.assertEqual(f(value), None)
         self.assertEqual(f("1970.01.01"), "1970.01.01")
 
+    def test_parse_datetime_iso(self, f=text.parse_datetime_iso):
+        null = util.datetime_utcfromtimestamp(0)
+
+        self.assertEqual(f("1970-01-01T00:00:00+00:00"), null)
+        self.assertEqual(f("1970-01-01T00:00:00Z")     , null)
+        self.assertEqual(f("1970-01-01T00:00:00")      , null)
+
+        self.assertEqual(
+            f("2019-05-07T21:25:02+09:00"),
+            datetime.datetime(2019, 5, 7, 12, 25, 2),
+        )
+        self.assertEqual(
+            f("2019-05-07T21:25:02.753+09:00"),
+            datetime.datetime(2019, 5, 7, 12, 25, 2),
+        )
+        self.assertEqual(
+            f("2019-05-07T21:25:02.753000Z"),
+            datetime.datetime(2019, 5, 7, 21, 25, 2),
+        )
+
+        for value in INVALID:
+            self.assertEqual(f(value), None)
+        self.assertEqual(f("1970.01.01"), "1970.01.01")
+        self.assertEqual(f(""), "")
+
 
 if __name__ == "__main__":
     unittest.main()